@@ -1,9 +1,182 @@
-from typing import List, Tuple, Set
+from itertools import chain
+from typing import List, Tuple, Set, Union
 
-from preprocessing import LabeledAlignment
+import numpy as np
 
+from preprocessing import LabeledAlignment, encode_segments, segment_offsets
 
-def compute_precision(reference: List[LabeledAlignment], predicted: List[List[Tuple[int, int]]]) -> Tuple[int, int]:
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+
+def _merge_count(a: np.ndarray, b: np.ndarray) -> int:
+    """
+    Counts common elements of two sorted arrays without duplicates with a two-pointer merge.
+    """
+    i = 0
+    j = 0
+    c = 0
+    while i < a.size and j < b.size:
+        if a[i] == b[j]:
+            c += 1
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            i += 1
+        else:
+            j += 1
+    return c
+
+
+def _flatten(arrays: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Concatenates per-sentence code arrays into one contiguous buffer. Sentence k occupies
+    flat[offsets[k]:offsets[k + 1]].
+    """
+    if not arrays:
+        return np.empty(0, dtype=np.int64), segment_offsets([])
+    offsets = segment_offsets([a.size for a in arrays])
+    return np.concatenate(arrays).astype(np.int64, copy=False), offsets
+
+
+def _reduce_counts(preds, pred_offsets, sures, sure_offsets, unions, union_offsets):
+    """
+    Sums intersection and set sizes over sentences given as flat code buffers with offsets (see `_flatten`).
+    """
+    # sentences are independent, with numba the += below become per-thread reductions
+    inter_possible = 0
+    inter_sure = 0
+    total_predicted = 0
+    total_sure = 0
+    for k in prange(pred_offsets.size - 1):
+        pred = preds[pred_offsets[k]:pred_offsets[k + 1]]
+        sure = sures[sure_offsets[k]:sure_offsets[k + 1]]
+        union = unions[union_offsets[k]:union_offsets[k + 1]]
+        inter_possible += count_intersect(pred, union)
+        inter_sure += count_intersect(pred, sure)
+        total_predicted += pred.size
+        total_sure += sure.size
+    return inter_possible, inter_sure, total_predicted, total_sure
+
+
+if njit is not None:
+    count_intersect = njit(cache=True)(_merge_count)
+    _reduce_counts = njit(parallel=True, cache=True)(_reduce_counts)
+else:
+    # the interpreted merge loop is slower than numpy, so use intersect1d when numba is not installed
+    def count_intersect(a: np.ndarray, b: np.ndarray) -> int:
+        return np.intersect1d(a, b, assume_unique=True).size
+
+
+def encode_alignments(predicted: Union[List[Set[Tuple[int, int]]], List[np.ndarray]]) -> List[np.ndarray]:
+    """
+    Encodes predicted alignments once, so that they can be passed to several metric functions without
+    being re-encoded by each of them. The input must be of one kind: either every alignment is a set of
+    tuples, or every alignment is already encoded, in which case the list is returned as is.
+
+    Args:
+        predicted: list of alignments, i.e. sets of tuples (source_pos, target_pos), or of 1-d code arrays
+
+    Returns:
+        encoded: list of sorted np.int64 arrays, see `preprocessing.encode`
+    """
+    if _is_encoded(predicted):
+        return list(predicted)
+    codes, offsets = _encode_flat(predicted)
+    return np.split(codes, offsets[1:-1])
+
+
+class EncodedReference:
+    """
+    Flat buffers (see `_flatten`) of the cached `sure_enc` and `union_enc` codes of a reference corpus.
+    Build it once with `encode_reference` and pass it to the metric functions in place of the list of
+    `LabeledAlignment`s, so that the reference is not flattened again on every call.
+    """
+    __slots__ = ('sures', 'sure_offsets', 'unions', 'union_offsets')
+
+    def __init__(self, reference: List[LabeledAlignment]):
+        self.sures, self.sure_offsets = _flatten([ref.sure_enc for ref in reference])
+        self.unions, self.union_offsets = _flatten([ref.union_enc for ref in reference])
+
+    def __len__(self):
+        return self.sure_offsets.size - 1
+
+
+def encode_reference(reference: Union[List[LabeledAlignment], EncodedReference]) -> EncodedReference:
+    """
+    Packs reference alignments once for repeated metric evaluations, e.g. printing precision, recall and AER.
+    An already encoded reference is returned as is.
+
+    Args:
+        reference: list of alignments with encoded fields `union_enc` and `sure_enc`
+
+    Returns:
+        encoded: flat reference buffers accepted by all metric functions
+    """
+    if isinstance(reference, EncodedReference):
+        return reference
+    return EncodedReference(reference)
+
+
+def _is_encoded(predicted: Union[List[Set[Tuple[int, int]]], List[np.ndarray]]) -> bool:
+    """
+    Tells whether every alignment is already a 1-d code array, refusing lists that mix both kinds.
+    """
+    encoded = [isinstance(pred, np.ndarray) and pred.ndim == 1 for pred in predicted]
+    if any(encoded) and not all(encoded):
+        raise TypeError('predicted alignments mix encoded arrays with sets of pairs')
+    return all(encoded)
+
+
+def _encode_flat(predicted: List[Set[Tuple[int, int]]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Encodes the alignments of all sentences in one pass into a flat buffer of codes with offsets (see `_flatten`),
+    reading every pair once and packing them with `preprocessing.encode_segments`.
+    """
+    sizes = np.fromiter(map(len, predicted), dtype=np.int64, count=len(predicted))
+    pairs = np.fromiter(chain.from_iterable(chain.from_iterable(predicted)), dtype=np.int64,
+                        count=2 * int(sizes.sum())).reshape(-1, 2)
+    return encode_segments(pairs, sizes)
+
+
+def _kernel_inputs(reference: Union[List[LabeledAlignment], EncodedReference],
+                   predicted: Union[List[Set[Tuple[int, int]]], List[np.ndarray]]) -> Tuple[np.ndarray, ...]:
+    """
+    Packs encoded predictions together with the reference buffers into the flat buffers consumed by
+    `_reduce_counts`.
+    """
+    ref = encode_reference(reference)
+    n = min(len(ref), len(predicted))
+    predicted = predicted[:n]
+    preds = _flatten(list(predicted)) if _is_encoded(predicted) else _encode_flat(predicted)
+    return (*preds, ref.sures, ref.sure_offsets[:n + 1], ref.unions, ref.union_offsets[:n + 1])
+
+
+def _counts(reference: Union[List[LabeledAlignment], EncodedReference],
+            predicted: Union[List[Set[Tuple[int, int]]], List[np.ndarray]]) -> Tuple[int, int, int, int]:
+    """
+    Computes all the counts needed for precision, recall and AER in a single pass over the sentences.
+    With numba installed the sentences are processed in parallel.
+
+    Args:
+        reference: list of alignments with encoded fields `union_enc` and `sure_enc`, or `encode_reference` of it
+        predicted: list of alignments as returned by the aligners, i.e. np.int64 code arrays, or sets of tuples
+
+    Returns:
+        inter_possible: |predicted and (possible or sure)|, summed over all sentences
+        inter_sure: |predicted and sure|, summed over all sentences
+        total_predicted: total number of predicted alignments over all sentences
+        total_sure: total number of sure alignments over all sentences
+    """
+    inter_possible, inter_sure, total_predicted, total_sure = _reduce_counts(*_kernel_inputs(reference, predicted))
+    return int(inter_possible), int(inter_sure), int(total_predicted), int(total_sure)
+
+
+def compute_precision(reference: Union[List[LabeledAlignment], EncodedReference],
+                      predicted: Union[List[Set[Tuple[int, int]]], List[np.ndarray]]) -> Tuple[int, int]:
     """
     Computes the numerator and the denominator of the precision for predicted alignments.
     Numerator : |predicted and possible|
@@ -11,67 +184,53 @@ def compute_precision(reference: List[LabeledAlignment], predicted: List[List[Tu
     Note that for correct metric values `sure` needs to be a subset of `possible`, but it is not the case for input data.
 
     Args:
-        reference: list of alignments with fields `possible` and `sure`
-        predicted: list of alignments, i.e. lists of tuples (source_pos, target_pos)
+        reference: list of alignments with fields `possible` and `sure`, or `encode_reference` of it
+        predicted: list of alignments as returned by the aligners, i.e. np.int64 code arrays, or sets of tuples
 
     Returns:
         intersection: number of alignments that are both in predicted and possible sets, summed over all sentences
         total_predicted: total number of predicted alignments over all sentences
     """
 
-    sum_2 = 0
-    sum_predicted = 0
-    for k1, k2 in zip(reference, predicted):
-        s1 = set(k1.possible)
-        s1.update(k1.sure)
-        s2 = set(k2)
-        sum_predicted += len(s2)
-        sum_2 += len(s1.intersection(s2))
-
-    return sum_2, sum_predicted
+    inter_possible, _, total_predicted, _ = _counts(reference, predicted)
+    return inter_possible, total_predicted
 
 
-def compute_recall(reference: List[LabeledAlignment], predicted: List[List[Tuple[int, int]]]) -> Tuple[int, int]:
+def compute_recall(reference: Union[List[LabeledAlignment], EncodedReference],
+                   predicted: Union[List[Set[Tuple[int, int]]], List[np.ndarray]]) -> Tuple[int, int]:
     """
     Computes the numerator and the denominator of the recall for predicted alignments.
     Numerator : |predicted and sure|
     Denominator: |sure|
 
     Args:
-        reference: list of alignments with fields `possible` and `sure`
-        predicted: list of alignments, i.e. lists of tuples (source_pos, target_pos)
+        reference: list of alignments with fields `possible` and `sure`, or `encode_reference` of it
+        predicted: list of alignments as returned by the aligners, i.e. np.int64 code arrays, or sets of tuples
 
     Returns:
         intersection: number of alignments that are both in predicted and sure sets, summed over all sentences
         total_predicted: total number of sure alignments over all sentences
     """
-    sum_2 = 0
-    sum_sure = 0
-    for k1, k2 in zip(reference, predicted):
-        k1 = k1.sure
-        s1 = set(k1)
-        s2 = set(k2)
-        sum_sure += len(s1)
-        sum_2 += len(s1.intersection(s2))
-
-    return sum_2, sum_sure
+    _, inter_sure, _, total_sure = _counts(reference, predicted)
+    return inter_sure, total_sure
 
 
-def compute_aer(reference: List[LabeledAlignment], predicted: List[List[Tuple[int, int]]]) -> float:
+def compute_aer(reference: Union[List[LabeledAlignment], EncodedReference],
+                predicted: Union[List[Set[Tuple[int, int]]], List[np.ndarray]]) -> float:
     """
     Computes the alignment error rate for predictions.
     AER=1-(|predicted and possible|+|predicted and sure|)/(|predicted|+|sure|)
-    Please use compute_precision and compute_recall to reduce code duplication.
+    Precision and recall counts come from a single pass over the sentences shared with compute_precision and
+    compute_recall.
 
     Args:
-        reference: list of alignments with fields `possible` and `sure`
-        predicted: list of alignments, i.e. lists of tuples (source_pos, target_pos)
+        reference: list of alignments with fields `possible` and `sure`, or `encode_reference` of it
+        predicted: list of alignments as returned by the aligners, i.e. np.int64 code arrays, or sets of tuples
 
     Returns:
         aer: the alignment error rate
     """
-    ap, a = compute_precision(reference, predicted)
-    sa, s = compute_recall(reference, predicted)
+    ap, sa, a, s = _counts(reference, predicted)
     return 1 - (ap + sa) / (a + s)
 
 #
@@ -1,6 +1,5 @@
 from abc import ABC, abstractmethod
-from itertools import product
-from typing import List, Tuple
+from typing import List
 
 import numpy as np
 
@@ -25,7 +24,7 @@ class BaseAligner(ABC):
         pass
 
     @abstractmethod
-    def align(self, sentences: List[TokenizedSentencePair]) -> List[List[Tuple[int, int]]]:
+    def align(self, sentences: List[TokenizedSentencePair]) -> List[np.ndarray]:
         """
         Given a list of tokenized sentences, predict alignments of source and target words.
 
@@ -33,8 +32,8 @@ class BaseAligner(ABC):
             sentences: list of sentences with translations, given as numpy arrays of vocabulary indices
 
         Returns:
-            alignments: list of alignments for each sentence pair, i.e. lists of tuples (source_pos, target_pos).
-            Alignment positions in sentences start from 1.
+            alignments: list of alignments for each sentence pair, i.e. sorted np.int64 arrays of codes
+            `source_pos << 32 | target_pos` (see `preprocessing.encode`). Alignment positions in sentences start from 1.
         """
         pass
 
@@ -57,13 +56,10 @@ class DiceAligner(BaseAligner):
     def align(self, sentences):
         result = []
         for sentence in sentences:
-            alignment = []
-            for (i, source_token), (j, target_token) in product(
-                    enumerate(sentence.source_tokens, 1),
-                    enumerate(sentence.target_tokens, 1)):
-                if self.dice_scores[source_token, target_token] > self.threshold:
-                    alignment.append((i, j))
-            result.append(alignment)
+            scores = self.dice_scores[sentence.source_tokens[:, np.newaxis], sentence.target_tokens[np.newaxis, :]]
+            # nonzero walks the matrix in row-major order, so the codes come out sorted
+            i, j = np.nonzero(scores > self.threshold)
+            result.append(((i + 1).astype(np.int64) << 32) | (j + 1))
         return result
 
 
@@ -168,9 +164,10 @@ class WordAligner(BaseAligner):
     def align(self, sentences):
         q = self._e_step(sentences)
         result = []
-        ind = np.arange(1, self.num_target_words + 1)
         for k in range(len(sentences)):
-            result.append(list(zip(np.argmax(q[k], axis=0) + 1, ind[:q[k].shape[1]])))
+            source_pos = np.argmax(q[k], axis=0).astype(np.int64) + 1
+            target_pos = np.arange(1, q[k].shape[1] + 1)
+            result.append(np.sort((source_pos << 32) | target_pos))
         return result
 
 
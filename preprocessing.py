@@ -1,35 +1,171 @@
-from dataclasses import dataclass
-from typing import Dict, List, Tuple
+from collections import Counter
+from typing import Dict, Iterator, List, Optional, Tuple
 import numpy as np
-import xml.etree.ElementTree as ET
 import re
+import sys
+import xml.etree.ElementTree as ET
+
+# a bare '&' that does not start a predefined or numeric character reference
+_BARE_AMP = re.compile(rb'&(?!(?:amp|lt|gt|quot|apos|#[0-9]+|#x[0-9a-fA-F]+);)')
+
 
-@dataclass(frozen=True)
 class SentencePair:
     """
     Contains lists of tokens (strings) for source and target sentence
     """
-    source: List[str]
-    target: List[str]
+    __slots__ = ('source', 'target')
+
+    def __init__(self, source: List[str], target: List[str]):
+        self.source = source
+        self.target = target
+
+    def __repr__(self):
+        return f'SentencePair(source={self.source!r}, target={self.target!r})'
 
 
-@dataclass(frozen=True)
 class TokenizedSentencePair:
     """
-    Contains arrays of token vocabulary indices (preferably np.int32) for source and target sentence
+    Contains np.int32 arrays of token vocabulary indices for source and target sentence
     """
-    source_tokens: np.ndarray
-    target_tokens: np.ndarray
+    __slots__ = ('source_tokens', 'target_tokens')
+
+    def __init__(self, source_tokens: np.ndarray, target_tokens: np.ndarray):
+        # no copy is made when the indices are already np.int32
+        self.source_tokens = np.asarray(source_tokens, dtype=np.int32)
+        self.target_tokens = np.asarray(target_tokens, dtype=np.int32)
+
+    def __repr__(self):
+        return f'TokenizedSentencePair(source_tokens={self.source_tokens!r}, target_tokens={self.target_tokens!r})'
 
 
-@dataclass(frozen=True)
 class LabeledAlignment:
     """
-    Contains arrays of alignments (lists of tuples (source_pos, target_pos)) for a given sentence.
-    Positions are numbered from 1.
+    Contains alignments (np.int32 arrays of shape (N, 2) with rows (source_pos, target_pos)) for a given sentence.
+    Positions are numbered from 1. `sure_enc` and `union_enc` hold `sure` and `possible | sure`
+    packed with `encode`; they are computed once on construction and reused by the metrics.
+    """
+    __slots__ = ('sure', 'possible', 'sure_enc', 'union_enc')
+
+    def __init__(self, sure: np.ndarray, possible: np.ndarray):
+        self.sure = np.asarray(sure, dtype=np.int32).reshape(-1, 2)
+        self.possible = np.asarray(possible, dtype=np.int32).reshape(-1, 2)
+        self.sure_enc = encode(self.sure)
+        self.union_enc = encode(np.concatenate((self.sure, self.possible)))
+
+    def __repr__(self):
+        return f'LabeledAlignment(sure={self.sure.tolist()!r}, possible={self.possible.tolist()!r})'
+
+
+def segment_offsets(sizes: np.ndarray) -> np.ndarray:
+    """
+    Turns per-sentence sizes into offsets into a flat buffer: sentence k occupies flat[offsets[k]:offsets[k + 1]].
+    """
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    return offsets
+
+
+def _pack(pairs: np.ndarray) -> np.ndarray:
+    """
+    Packs every row (source_pos, target_pos) of an (N, 2) array into one int64 code `source_pos << 32 | target_pos`.
+    """
+    pairs = np.asarray(pairs, dtype=np.int64)
+    return (pairs[:, 0] << 32) | pairs[:, 1]
+
+
+def encode_segments(pairs: np.ndarray, sizes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Packs the alignment pairs of several sentences into int64 codes `source_pos << 32 | target_pos`, sorted and
+    without duplicates within each sentence, so that alignments can be intersected with numpy or numba instead
+    of Python sets.
+
+    Args:
+        pairs: array of shape (N, 2) with rows (source_pos, target_pos), sentence after sentence
+        sizes: number of rows of every sentence in `pairs`
+
+    Returns:
+        codes: flat np.int64 buffer of the codes of all sentences
+        offsets: sentence k occupies codes[offsets[k]:offsets[k + 1]], see `segment_offsets`
+    """
+    codes = _pack(pairs)
+    offsets = segment_offsets(sizes)
+    # segments are short, so sorting each view in place is cheaper than a global lexsort
+    for k in range(len(sizes)):
+        codes[offsets[k]:offsets[k + 1]].sort()
+
+    # a code is kept if it differs from its predecessor or starts a sentence
+    keep = np.empty(codes.size, dtype=bool)
+    keep[1:] = codes[1:] != codes[:-1]
+    keep[offsets[:-1][offsets[:-1] < codes.size]] = True
+    kept_before = np.zeros(codes.size + 1, dtype=np.int64)
+    np.cumsum(keep, out=kept_before[1:])
+    return codes[keep], kept_before[offsets]
+
+
+def encode(pairs: np.ndarray) -> np.ndarray:
     """
-    sure: List[Tuple[int, int]]
-    possible: List[Tuple[int, int]]
+    Packs the alignment pairs of one sentence, see `encode_segments`. A single sentence needs no segment
+    bookkeeping, so np.unique sorts and deduplicates the codes in one call.
+
+    Args:
+        pairs: array of shape (N, 2) with rows (source_pos, target_pos)
+
+    Returns:
+        codes: sorted np.int64 array without duplicates
+    """
+    return np.unique(_pack(pairs))
+
+
+def decode(codes: np.ndarray) -> np.ndarray:
+    """
+    Inverse of `encode`: unpacks int64 codes back into an array of shape (N, 2) with rows (source_pos, target_pos).
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    return np.stack((codes >> 32, codes & 0xFFFFFFFF), axis=1)
+
+
+def _parse_pairs(text: Optional[str]) -> np.ndarray:
+    """
+    Parses alignment text like `1-2 3-4` into an np.int32 array of shape (N, 2).
+    """
+    if not text:
+        return np.empty((0, 2), dtype=np.int32)
+    return np.fromstring(text.replace('-', ' '), sep=' ', dtype=np.int32).reshape(-1, 2)
+
+
+def _escaped_chunks(filename: str, size_hint: int = 1 << 16) -> Iterator[bytes]:
+    """
+    Reads an alignment file in chunks of whole lines, escaping bare `&` so that the chunks form well-formed XML.
+    Chunks end on line boundaries, so an entity is never split between two of them.
+    """
+    with open(filename, 'rb') as file:
+        for lines in iter(lambda: file.readlines(size_hint), []):
+            yield _BARE_AMP.sub(b'&amp;', b''.join(lines))
+
+
+def _iter_sentences(filename: str) -> Iterator[ET.Element]:
+    """
+    Incrementally parses an alignment file and yields its `<s>` elements one by one. The files contain raw `&`,
+    so it is escaped on the fly, leaving already well-formed entities intact. Consumed sentences are removed
+    from the tree, so memory does not grow with the size of the file.
+
+    Args:
+        filename: Name of the file containing XML markup for labeled alignments
+
+    Returns:
+        sentences: iterator over complete `<s>` elements
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    root = None
+    for chunk in _escaped_chunks(filename):
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if root is None:
+                root = elem
+            elif event == 'end' and elem.tag == 's':
+                yield elem
+                root.clear()
+    parser.close()
 
 
 def extract_sentences(filename: str) -> Tuple[List[SentencePair], List[LabeledAlignment]]:
@@ -47,37 +183,16 @@ def extract_sentences(filename: str) -> Tuple[List[SentencePair], List[LabeledAl
     sentence_pairs = []
     alignments = []
 
-    with open(filename) as file:
-        with open('my_file.txt', 'w') as f:
-            for line in file:
-                s = re.sub('\&', '&amp;', line)
-                f.write(s)
-
-    tree = ET.parse('my_file.txt')
-    root = tree.getroot()
-    s1, s2 = [], []
-    p1, p2 = [], []
-    for i in range(len(root)):
-        for j in range(len(root[i])):
-            if root[i][j].tag == 'english':
-                s1 = root[i][j].text.split()
-
-            if root[i][j].tag == 'czech':
-                s2 = root[i][j].text.split()
-
-            if root[i][j].tag == 'sure':
-                s = root[i][j].text
-                if s is None:
-                    s = ''
-                s = s.split()
-                p1 = [(int(i.split('-')[0]), int(i.split('-')[1])) for i in s]
-
-            if root[i][j].tag == 'possible':
-                s = root[i][j].text
-                if s is None:
-                    s = ''
-                s = s.split()
-                p2 = [(int(i.split('-')[0]), int(i.split('-')[1])) for i in s]
+    for sentence in _iter_sentences(filename):
+        en = sentence.find('english')
+        cz = sentence.find('czech')
+        sure = sentence.find('sure')
+        poss = sentence.find('possible')
+        # interned tokens are hashed once and compared by identity in the vocabulary lookups
+        s1 = [sys.intern(tok) for tok in en.text.split()] if en is not None and en.text else []
+        s2 = [sys.intern(tok) for tok in cz.text.split()] if cz is not None and cz.text else []
+        p1 = _parse_pairs(sure.text if sure is not None else None)
+        p2 = _parse_pairs(poss.text if poss is not None else None)
 
         obj2 = LabeledAlignment(p1, p2)
         obj1 = SentencePair(s1, s2)
@@ -87,6 +202,25 @@ def extract_sentences(filename: str) -> Tuple[List[SentencePair], List[LabeledAl
     return sentence_pairs, alignments
 
 
+def _top_indices(counts: np.ndarray, k: Optional[int]) -> np.ndarray:
+    """
+    Returns indices of the k largest counts (all of them if k is None) in decreasing order of count.
+    Ties are broken by position, also when the cutoff falls inside a group of equal counts: the earliest
+    of the tied entries are kept.
+    """
+    if k is None or k >= counts.size:
+        return np.argsort(-counts, kind='stable')
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    # np.partition finds the k-th largest count in linear time; argpartition is avoided on purpose,
+    # since it keeps an arbitrary subset of the entries tied at the cutoff
+    threshold = np.partition(counts, counts.size - k)[counts.size - k]
+    greater = np.flatnonzero(counts > threshold)
+    tied = np.flatnonzero(counts == threshold)[:k - greater.size]
+    top = np.sort(np.concatenate((greater, tied)))
+    return top[np.argsort(-counts[top], kind='stable')]
+
+
 def get_token_to_index(sentence_pairs: List[SentencePair], freq_cutoff=None) -> Tuple[Dict[str, int], Dict[str, int]]:
     """
     Given a parallel corpus, create two dictionaries token->index for source and target language.
@@ -101,44 +235,24 @@ def get_token_to_index(sentence_pairs: List[SentencePair], freq_cutoff=None) ->
         
     Tip: 
         Use cutting by freq_cutoff independently in src and target. Moreover in both cases of freq_cutoff (None or not None) - you may get a different size of the dictionary
+        Tokens with equal counts are ordered by their first occurrence in the corpus.
 
     """
-    tokens_source = []
-    count_source = []
-    tokens_target = []
-    count_target = []
+    src_counter = Counter()
+    tgt_counter = Counter()
     for obj in sentence_pairs:
-        for tok in obj.source:
-            if tok in tokens_source:
-                ind = tokens_source.index(tok)
-                count_source[ind] += 1
-            else:
-                tokens_source.append(tok)
-                count_source.append(0)
+        src_counter.update(obj.source)
+        tgt_counter.update(obj.target)
 
-        for tok in obj.target:
-            if tok in tokens_target:
-                ind = tokens_target.index(tok)
-                count_target[ind] += 1
-            else:
-                tokens_target.append(tok)
-                count_target.append(0)
-
-    tokens_source = np.array(tokens_source)
-    count_source = np.array(count_source)
-    tokens_target = np.array(tokens_target)
-    count_target = np.array(count_target)
-
-    ind_source = np.argsort(count_source)[::-1]
-    ind_target = np.argsort(count_target)[::-1]
-    tokens_source = tokens_source[ind_source]
-    tokens_target = tokens_target[ind_target]
-    if freq_cutoff is not None:
-        tokens_source = tokens_source[:freq_cutoff]
-        tokens_target = tokens_target[:freq_cutoff]
-
-    return dict(zip(tokens_source, np.arange(len(tokens_source)))), \
-           dict(zip(tokens_target, np.arange(len(tokens_target))))
+    # counters iterate in first-occurrence order, so _top_indices breaks ties, including the ones at
+    # freq_cutoff, in favour of the token seen first, exactly like Counter.most_common
+    tokens_source = list(src_counter)
+    tokens_target = list(tgt_counter)
+    ind_source = _top_indices(np.fromiter(src_counter.values(), dtype=np.int64, count=len(src_counter)), freq_cutoff)
+    ind_target = _top_indices(np.fromiter(tgt_counter.values(), dtype=np.int64, count=len(tgt_counter)), freq_cutoff)
+
+    return {sys.intern(tokens_source[ind]): i for i, ind in enumerate(ind_source.tolist())}, \
+           {sys.intern(tokens_target[ind]): i for i, ind in enumerate(ind_target.tolist())}
 
 
 def tokenize_sents(sentence_pairs: List[SentencePair], source_dict, target_dict) -> List[TokenizedSentencePair]:
@@ -156,27 +270,30 @@ def tokenize_sents(sentence_pairs: List[SentencePair], source_dict, target_dict)
         tokenized_sentence_pairs: sentences from sentence_pairs, tokenized using source_dict and target_dict
     """
     answ = []
+    src_get = source_dict.get
+    tgt_get = target_dict.get
     for obj in sentence_pairs:
         source_sentence = []
         target_sentence = []
         not_tok = False
         for tok in obj.source:
-            if tok in source_dict.keys():
-                source_sentence.append(source_dict[tok])
-            else:
+            idx = src_get(tok)
+            if idx is None:
                 not_tok = True
                 break
+            source_sentence.append(idx)
         if not_tok:
             continue
 
         for tok in obj.target:
-            if tok in target_dict.keys():
-                target_sentence.append(target_dict[tok])
-            else:
+            idx = tgt_get(tok)
+            if idx is None:
                 not_tok = True
                 break
+            target_sentence.append(idx)
         if not_tok:
             continue
 
-        answ.append(TokenizedSentencePair(np.array(source_sentence), np.array(target_sentence)))
+        answ.append(TokenizedSentencePair(np.array(source_sentence, dtype=np.int32),
+                                          np.array(target_sentence, dtype=np.int32)))
     return answ